@@ -1,18 +1,31 @@
 import asyncio
+import collections
+import hashlib
+import itertools
 import os
 import time
+import uuid
+from urllib.parse import quote, urlsplit
 
-import httpx
+import httpcore
+import jwt
 import redis.asyncio as aioredis
+from cachetools import LRUCache, TTLCache
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, Response
-from jose import JWTError, jwt
+from fastapi.responses import ORJSONResponse, Response
 from opentelemetry import trace
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
 
 # ======== OTEL Tracing Setup ========
 trace.set_tracer_provider(TracerProvider())
@@ -26,7 +39,9 @@ trace.get_tracer_provider().add_span_processor(
 )
 
 # ======== FastAPI app ========
-app = FastAPI(title="API Gateway", version="1.0.0")
+app = FastAPI(
+    title="API Gateway", version="1.0.0", default_response_class=ORJSONResponse
+)
 FastAPIInstrumentor.instrument_app(app)
 
 # ======== ENV VARS ========
@@ -34,6 +49,15 @@ BACKEND_URL = os.getenv("BACKEND_URL", "http://backend:8000")
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 JWT_SECRET = os.getenv("JWT_SECRET", "supersecretkey")
 GLOBAL_RATE = int(os.getenv("GLOBAL_RATE", "10000"))  # req/sec
+# Uvicorn worker count; each worker holds its own local buckets, so the local
+# limit is split between them to keep the node-wide total at GLOBAL_RATE
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+LOCAL_RATE = int(os.getenv("LOCAL_RATE", max(1, GLOBAL_RATE // WORKERS)))  # req/sec
+# Set when running several workers: metrics are written to this directory by
+# every worker and aggregated on scrape (prometheus_client multiprocess mode)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Backend routes reported as their own metrics endpoint; others are "unmatched"
+PROXY_ENDPOINTS = frozenset(os.getenv("PROXY_ENDPOINTS", "/api/resource").split(","))
 
 # ======== Metrics ========
 REQUEST_COUNT = Counter(
@@ -48,115 +72,284 @@ RATE_LIMITED_COUNT = Counter(
     ["endpoint"],
 )
 
+# Cache of metric children keyed by (metric, label values), so the hot path
+# skips prometheus_client's label validation + locked dict lookup. Bounded so
+# unexpected label values fall back to a plain .labels() call.
+METRIC_CHILD_CACHE_SIZE = 1024
+metric_children = {}
+
+
+def metric_child(metric, *label_values):
+    key = (metric, label_values)
+    child = metric_children.get(key)
+    if child is None:
+        child = metric.labels(*label_values)
+        if len(metric_children) < METRIC_CHILD_CACHE_SIZE:
+            metric_children[key] = child
+    return child
+
+
+def endpoint_label(path: str) -> str:
+    # Raw request paths are user-controlled: bound the label set
+    return path if path in PROXY_ENDPOINTS else "unmatched"
+
+
+# Request observations are queued here by the middleware and applied to the
+# metrics in batches, keeping Histogram.observe (lock + bucket walk) off the
+# request path. Up to METRICS_FLUSH_INTERVAL stale; oldest dropped if full.
+METRICS_FLUSH_INTERVAL = 0.1  # seconds
+pending_observations = collections.deque(maxlen=65536)
+
+
+def flush_observations():
+    while pending_observations:
+        method, endpoint, status_code, duration = pending_observations.popleft()
+        metric_child(REQUEST_COUNT, method, endpoint, status_code).inc()
+        metric_child(REQUEST_LATENCY, endpoint).observe(duration)
+
+
+async def metrics_flusher():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        flush_observations()
+
+
 # ======== Redis Client ========
-redis_client = aioredis.from_url(REDIS_URL, decode_responses=True)
+# Replies stay raw bytes: the limiter only reads integer replies
+redis_client = aioredis.from_url(REDIS_URL)
+
+# Sliding-window log: one sorted set per api_key scored by request time (ms).
+# Trims entries older than the window and records only the coalesced requests
+# that still fit under the limit, so rejected requests never occupy the window;
+# all in one atomic round-trip (EVALSHA after first use).
+# ARGV = now_ms, window_ms, unique member prefix, number of coalesced requests,
+# limit. Returns the window's size before this batch was added.
+RATE_LIMIT_LUA = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+local card = redis.call('ZCARD', KEYS[1])
+local admit = math.min(tonumber(ARGV[4]), tonumber(ARGV[5]) - card)
+for i = 1, admit do
+    redis.call('ZADD', KEYS[1], now, ARGV[3] .. ':' .. i)
+end
+redis.call('PEXPIRE', KEYS[1], window)
+return card
+"""
+rate_limit_script = redis_client.register_script(RATE_LIMIT_LUA)
+
+# ======== Backend Connection Pool ========
+# httpcore directly: BACKEND_URL is fixed, so the URL parts and Host header are
+# computed once instead of going through httpx's per-request URL/header layer.
+backend_url = urlsplit(BACKEND_URL)
+BACKEND_SCHEME = backend_url.scheme.encode()
+BACKEND_HOST = backend_url.hostname.encode()
+BACKEND_PORT = backend_url.port or (443 if backend_url.scheme == "https" else 80)
+BACKEND_PATH_PREFIX = backend_url.path.rstrip("/").encode()
+BACKEND_HOST_HEADER = (b"host", backend_url.netloc.encode())
+BACKEND_TIMEOUTS = {"timeout": dict.fromkeys(("connect", "read", "write", "pool"), 5.0)}
+
+backend_pool = httpcore.AsyncConnectionPool(
+    max_connections=500, max_keepalive_connections=100, keepalive_expiry=60.0
+)
 
-# ======== HTTPX Client ========
-http_client = httpx.AsyncClient(timeout=5.0)
+# ======== Cached Clock ========
+# Refreshed by a background task so the hot path reads a dict instead of
+# calling time.time()/time.monotonic() per request. Accepts ~1ms skew.
+CLOCK_TICK = 0.001  # seconds
+clock = {"now": time.time(), "monotonic": time.monotonic()}
 
-# ======== Local Token Bucket ========
-RATE_WINDOW = 1.0
-local_tokens = GLOBAL_RATE
-last_refill = time.monotonic()
 
-bucket_lock = asyncio.Lock()
+async def clock_ticker():
+    while True:
+        await asyncio.sleep(CLOCK_TICK)
+        clock["now"] = time.time()
+        clock["monotonic"] = time.monotonic()
+
+
+# ======== Local Token Buckets ========
+RATE_WINDOW = 1.0
+# {api_key: [tokens, last_refill]}, bounded so random subs cannot grow it
+# forever; an evicted key simply starts again with a full bucket
+local_buckets = LRUCache(maxsize=100_000)
 
 # ======== JWT Cache ========
-jwt_cache = {}  # {token: (payload, expire_time)}
+JWT_ALGORITHMS = ("HS256",)
+# Claims are checked inside the single decode call
+JWT_DECODE_OPTIONS = {"require": ["exp", "sub"], "verify_aud": False}
+JWT_CACHE_TTL = 5.0  # seconds
+# {sha256(token): (payload, expire_time)}, bounded LRU with TTL eviction
+jwt_cache = TTLCache(maxsize=10000, ttl=JWT_CACHE_TTL)
 
 shutdown_event = asyncio.Event()
+background_tasks = []
 
 
 # ======== Startup / Shutdown ========
 @app.on_event("startup")
 async def startup_event():
     print("✅ Gateway starting up...")
+    background_tasks.append(asyncio.create_task(clock_ticker()))
+    background_tasks.append(asyncio.create_task(metrics_flusher()))
 
 
 @app.on_event("shutdown")
 async def shutdown_event_handler():
     print("🛑 Gateway shutting down gracefully...")
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    flush_observations()
     await redis_client.close()
-    await http_client.aclose()
+    await backend_pool.aclose()
 
 
 # ======== JWT Verification ========
 async def verify_jwt(token: str):
-    now = time.time()
+    now = clock["now"]
+    cache_key = hashlib.sha256(token.encode()).digest()
     # Check cache first
-    cached = jwt_cache.get(token)
+    cached = jwt_cache.get(cache_key)
     if cached and cached[1] > now:
         return cached[0]
 
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        # Cache for 60 seconds
-        jwt_cache[token] = (payload, now + 60)
+        payload = jwt.decode(
+            token, JWT_SECRET, algorithms=JWT_ALGORITHMS, options=JWT_DECODE_OPTIONS
+        )
+        # Never cache past the token's own expiry
+        expires_at = now + JWT_CACHE_TTL
+        expires_at = min(payload.get("exp", expires_at), expires_at)
+        jwt_cache[cache_key] = (payload, expires_at)
         return payload
-    except JWTError:
+    except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
 # ======== Rate Limiter ========
+def consume_local_token(api_key: str) -> bool:
+    # Synchronous on purpose: with no await between read and write the
+    # event loop cannot interleave callers, so no lock is needed.
+    now = clock["monotonic"]
+    bucket = local_buckets.get(api_key)
+    if bucket is None:
+        bucket = local_buckets[api_key] = [LOCAL_RATE, now]
+
+    elapsed = now - bucket[1]
+    refill = elapsed * LOCAL_RATE
+    if refill >= 1:
+        bucket[0] = min(LOCAL_RATE, bucket[0] + int(refill))
+        bucket[1] = now
+
+    if bucket[0] <= 0:
+        return False
+    bucket[0] -= 1
+    return True
+
+
+# Same-key increments arriving within RATE_COALESCE_WINDOW share one Redis
+# call; each waiter gets its own position in the resulting count.
+RATE_COALESCE_WINDOW = 0.002  # seconds
+pending_increments = {}  # {redis key: [future, ...]}
+coalesce_tasks = set()
+# Sorted-set members must be unique across gateway instances and batches
+INSTANCE_ID = uuid.uuid4().hex
+batch_ids = itertools.count()
+
+
+async def flush_increments(key: str):
+    await asyncio.sleep(RATE_COALESCE_WINDOW)
+    waiters = pending_increments.pop(key)
+    try:
+        now_ms = int(clock["now"] * 1000)
+        member = f"{INSTANCE_ID}:{next(batch_ids)}"
+        card = await rate_limit_script(
+            keys=[key],
+            args=[now_ms, int(RATE_WINDOW * 1000), member, len(waiters), GLOBAL_RATE],
+        )
+    except Exception as e:
+        for future in waiters:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    for seq, future in enumerate(waiters, start=card + 1):
+        if not future.done():
+            future.set_result(seq)
+
+
+async def incr_rate_counter(key: str) -> int:
+    future = asyncio.get_running_loop().create_future()
+    waiters = pending_increments.get(key)
+    if waiters is None:
+        pending_increments[key] = [future]
+        task = asyncio.create_task(flush_increments(key))
+        coalesce_tasks.add(task)
+        task.add_done_callback(coalesce_tasks.discard)
+    else:
+        waiters.append(future)
+    return await future
+
+
 async def rate_limiter(api_key: str):
-    global local_tokens, last_refill
-    async with bucket_lock:
-        now = time.monotonic()
-        elapsed = now - last_refill
-        refill = elapsed * GLOBAL_RATE
-        if refill >= 1:
-            local_tokens = min(GLOBAL_RATE, local_tokens + int(refill))
-            last_refill = now
-
-        if local_tokens <= 0:
-            raise HTTPException(
-                status_code=429, detail="Too many requests (local limit)"
-            )
-        local_tokens -= 1
+    if not consume_local_token(api_key):
+        raise HTTPException(status_code=429, detail="Too many requests (local limit)")
 
     # Redis global rate limit
-    key = f"rate:{api_key}:{int(time.time())}"
-    count = await redis_client.incr(key)
-    if count == 1:
-        await redis_client.expire(key, 1)
+    key = f"rate:{api_key}"
+    count = await incr_rate_counter(key)
 
     if count > GLOBAL_RATE:
         raise HTTPException(status_code=429, detail="Too many requests (global limit)")
 
 
-# ======== Metrics Middleware ========
-@app.middleware("http")
-async def metrics_middleware(request: Request, call_next):
-    start_time = time.perf_counter()
-    response: Response = None
-    try:
-        response = await call_next(request)
-        return response
-    finally:
-        process_time = time.perf_counter() - start_time
-        endpoint = request.url.path
-        status_code = response.status_code if response else 500
-        REQUEST_COUNT.labels(request.method, endpoint, status_code).inc()
-        REQUEST_LATENCY.labels(endpoint).observe(process_time)
-
-
-# ======== Auth & Rate Limit Middleware ========
-@app.middleware("http")
-async def auth_and_rate_limit(request: Request, call_next):
-    if request.url.path.startswith("/health") or request.url.path.startswith(
-        "/metrics"
-    ):
-        return await call_next(request)
-
-    auth_header = request.headers.get("authorization")
+# ======== Auth & Rate Limit + Proxy ========
+# Hop-specific headers not forwarded to the backend (ASGI names are lower-case);
+# Host and body framing are set by the proxy itself
+DROP_HEADERS = frozenset(
+    {b"host", b"content-length", b"transfer-encoding", b"connection"}
+)
+# Methods proxied without reading the request body
+BODYLESS_METHODS = frozenset({"GET", "HEAD", "DELETE"})
+
+
+def get_header(headers, name: bytes):
+    # ASGI header names are already lower-cased bytes
+    for key, value in headers:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+# Backend response headers copied back to the client. httpcore (unlike httpx)
+# does not decompress, and the client's Accept-Encoding is forwarded, so the
+# body may arrive encoded: content-encoding must travel with it untouched.
+PASSTHROUGH_RESPONSE_HEADERS = frozenset({b"content-type", b"content-encoding"})
+
+
+def backend_response_headers(headers) -> dict:
+    # httpcore keeps the backend's header-name casing
+    passthrough = {"content-type": "application/json"}
+    for key, value in headers:
+        key = key.lower()
+        if key in PASSTHROUGH_RESPONSE_HEADERS:
+            passthrough[key.decode("latin-1")] = value.decode("latin-1")
+    return passthrough
+
+
+async def auth_and_rate_limit(request: Request) -> Response:
+    auth_header = get_header(request.scope["headers"], b"authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse(status_code=401, content={"detail": "Missing token"})
+        return ORJSONResponse(status_code=401, content={"detail": "Missing token"})
 
     token = auth_header.split(" ", 1)[1]
-    payload = await verify_jwt(token)
+    try:
+        payload = await verify_jwt(token)
+    except HTTPException as e:
+        return ORJSONResponse(status_code=e.status_code, content={"detail": e.detail})
     api_key = payload.get("sub")
     if not api_key:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=401, content={"detail": "Invalid token payload"}
         )
 
@@ -164,30 +357,114 @@ async def auth_and_rate_limit(request: Request, call_next):
         await rate_limiter(api_key)
     except HTTPException as e:
         if e.status_code == 429:
-            RATE_LIMITED_COUNT.labels(request.url.path).inc()
-        return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+            metric_child(RATE_LIMITED_COUNT, endpoint_label(request.url.path)).inc()
+        return ORJSONResponse(status_code=e.status_code, content={"detail": e.detail})
 
     # Proxy to backend
+    # Forward the path exactly as the client encoded it, plus its query string
+    # (some servers leave the query in raw_path; a literal "?" is always %3F)
+    scope = request.scope
+    raw_path = scope.get("raw_path") or quote(scope["path"]).encode()
+    raw_path = raw_path.partition(b"?")[0]
+    target = BACKEND_PATH_PREFIX + raw_path
+    if scope["query_string"]:
+        target += b"?" + scope["query_string"]
+    headers = [(k, v) for k, v in request.headers.raw if k not in DROP_HEADERS]
+    headers.append(BACKEND_HOST_HEADER)
+    # Stream any body through instead of buffering it in the gateway, keeping
+    # the client's framing; with neither framing header there is no body
+    content = b""
+    if request.method not in BODYLESS_METHODS:
+        content_length = get_header(scope["headers"], b"content-length")
+        if content_length is not None:
+            headers.append((b"content-length", content_length.encode()))
+            content = request.stream()
+        elif get_header(scope["headers"], b"transfer-encoding") is not None:
+            headers.append((b"transfer-encoding", b"chunked"))
+            content = request.stream()
     try:
-        backend_resp = await http_client.request(
-            request.method,
-            f"{BACKEND_URL}{request.url.path}",
-            headers=request.headers.raw,
-            content=await request.body(),
+        backend_resp = await backend_pool.handle_async_request(
+            httpcore.Request(
+                request.method,
+                httpcore.URL(
+                    scheme=BACKEND_SCHEME,
+                    host=BACKEND_HOST,
+                    port=BACKEND_PORT,
+                    target=target,
+                ),
+                headers=headers,
+                content=content,
+                extensions=BACKEND_TIMEOUTS,
+            )
         )
-        # If backend returns non-JSON, fallback
         try:
-            content = backend_resp.json()
-        except Exception:
-            content = backend_resp.text
-        return JSONResponse(status_code=backend_resp.status_code, content=content)
+            resp_body = await backend_resp.aread()
+        finally:
+            await backend_resp.aclose()
+        # Pass the body and its type/encoding through untouched: no JSON parse /
+        # re-serialize, and no media_type so Starlette adds no extra charset
+        return Response(
+            content=resp_body,
+            status_code=backend_resp.status,
+            headers=backend_response_headers(backend_resp.headers),
+        )
     except Exception as e:
-        return JSONResponse(status_code=502, content={"detail": str(e)})
+        return ORJSONResponse(status_code=502, content={"detail": str(e)})
+
+
+# ======== Gateway Middleware ========
+PROBE_PATHS = frozenset({"/health", "/metrics"})
+
+
+class GatewayMiddleware:
+    """Pure ASGI middleware: metrics + auth/rate limit + proxy in one layer.
+
+    Avoids BaseHTTPMiddleware, which costs an extra task and body stream
+    copy per request for every ``@app.middleware("http")`` function.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Lifespan and probe/scrape traffic go straight to the routes:
+        # no auth, no timing, no metrics
+        if scope["type"] != "http" or scope["path"] in PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            response = await auth_and_rate_limit(Request(scope, receive))
+            await response(scope, receive, send_wrapper)
+        finally:
+            process_time = time.perf_counter() - start_time
+            pending_observations.append(
+                (scope["method"], endpoint_label(path), status_code, process_time)
+            )
+
+
+app.add_middleware(GatewayMiddleware)
 
 
 # ======== Metrics Endpoint ========
 @app.get("/metrics")
 async def metrics():
+    flush_observations()
+    if PROMETHEUS_MULTIPROC_DIR:
+        # Whichever worker answers the scrape reports the sum over all workers
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
@@ -1,24 +1,29 @@
 import os
+from uuid import uuid4
 
 import httpx
-import requests
 
 from locust import HttpUser, between, task
 
 GATEWAY_URL = os.getenv("LOCUST_HOST", "http://gateway:8080")
 AUTH_URL = os.getenv("AUTH_URL", "http://auth:8001/token")
-TOKEN = None
+
+# Shared pooled client so users reuse connections to the auth service
+AUTH_CLIENT = httpx.Client(
+    timeout=5.0, limits=httpx.Limits(max_keepalive_connections=20)
+)
 
 
 class GatewayUser(HttpUser):
     wait_time = between(0.01, 0.1)  # 10-100ms between requests
 
     def on_start(self):
-        global TOKEN
-        resp = httpx.get(AUTH_URL)
-        TOKEN = resp.json()["access_token"]
+        # Per-user token and sub: no shared global to race on, and each user
+        # is its own api_key for the gateway's JWT cache and rate limiters
+        resp = AUTH_CLIENT.get(AUTH_URL, params={"sub": f"user-{uuid4().hex}"})
+        self.token = resp.json()["access_token"]
 
     @task
     def hit_resource(self):
-        headers = {"Authorization": f"Bearer {TOKEN}"}
+        headers = {"Authorization": f"Bearer {self.token}"}
         self.client.get(f"{GATEWAY_URL}/api/resource", headers=headers)